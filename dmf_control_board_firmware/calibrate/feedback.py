@@ -8,8 +8,17 @@ circuits on the control board:
  - Impedance.
 '''
 import re
-from collections import OrderedDict, Iterable
-from functools32 import lru_cache
+from collections import OrderedDict
+try:
+    from collections.abc import Iterable
+except ImportError:
+    # Python 2
+    from collections import Iterable
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2
+    from functools32 import lru_cache
 
 import pandas as pd
 import sympy as sp
@@ -40,6 +49,11 @@ def _limit(eq, *args, **kwargs):
         return sp.limit(*args, **kwargs)
 
 
+@lru_cache(maxsize=500)
+def _lambdify(args, expr):
+    return sp.lambdify(args, expr, 'numpy')
+
+
 def swap_default(mode, equation, symbol_names, default, **kwargs):
     '''
     Given a `sympy` equation or equality, along with a list of symbol names,
@@ -307,7 +321,7 @@ def compute_from_transfer_function(hardware_major_version, solve_for,
             # `omega`.  Thus, remove `f` before performing value substitution.
             del kwargs['f']
     # Substitute scalar values from keyword arguments into symbolic equation.
-    for k, v in kwargs.iteritems():
+    for k, v in kwargs.items():
         if isinstance(v, Iterable):
             continue
         else:
@@ -321,7 +335,7 @@ def compute_from_transfer_function(hardware_major_version, solve_for,
         symbols = [s.name for s in H.atoms(sp.Symbol)]
         # Construct numeric equation with the unresolved RHS terms as
         # arguments.
-        func = sp.lambdify(', '.join(symbols), sp.Abs(H), 'numpy')
+        func = _lambdify(', '.join(symbols), sp.Abs(H))
         # Return resulting numeric function evaluated with provided keyword
         # value for each term.
         return func(*[kwargs[s] for s in symbols])
@@ -1,21 +1,44 @@
 # coding: utf-8
+from __future__ import division
+from collections import namedtuple
+import hashlib
+import itertools
 import logging
-
-from matplotlib.markers import MarkerStyle
-import matplotlib.pyplot as plt
+import os
+import tempfile
+
+try:
+    from functools import lru_cache
+except ImportError:
+    # Python 2
+    from functools32 import lru_cache
 import numpy as np
 import pandas as pd
 import scipy.optimize as optimize
 
-from .feedback import compute_from_transfer_function
+try:
+    import numba
+except ImportError:
+    numba = None
 
 logger = logging.getLogger(__name__)
 
+# RMS voltage samples from control board high-voltage feedback circuit, along
+# with the index of the feedback resistor used for each sample _(-1 if
+# invalid)_.
+BoardRMS = namedtuple('BoardRMS', 'V hv_resistor')
+
 
 def measure_board_rms(control_board, n_samples=10, sampling_ms=10,
                       delay_between_samples_ms=0):
     '''
     Read RMS voltage samples from control board high-voltage feedback circuit.
+
+    Returns
+    -------
+    BoardRMS
+        Arrays of measured RMS voltages and corresponding feedback resistor
+        indexes.
     '''
     try:
         results = control_board.measure_impedance(n_samples, sampling_ms,
@@ -23,41 +46,73 @@ def measure_board_rms(control_board, n_samples=10, sampling_ms=10,
                                                   True, True, [])
     except RuntimeError:
         # `RuntimeError` may be raised if, for example, current limit was
-        # reached during measurement.  In such cases, return an empty frame.
+        # reached during measurement.  In such cases, return empty arrays.
         logger.warning('Error encountered during high-voltage RMS '
                        'measurement.', exc_info=True)
-        data = pd.DataFrame(None, columns=['board measured V',
-                                           'divider resistor index'])
+        return BoardRMS(np.array([], dtype=float), np.array([], dtype=int))
     else:
-        data = pd.DataFrame({'board measured V': results.V_hv})
-        data['divider resistor index'] = results.hv_resistor
-    return data
+        return BoardRMS(np.asarray(results.V_hv),
+                        np.asarray(results.hv_resistor))
+
+
+@lru_cache(maxsize=512)
+def _cached_board_rms(control_board, frequency, voltage_uV, n_samples,
+                      sampling_ms, delay_between_samples_ms):
+    '''
+    Set the waveform voltage to ``voltage_uV`` *(in micro-volts)* and read RMS
+    voltage samples from control board high-voltage feedback circuit.
+
+    The waveform voltage is only set on a cache miss, i.e., when a measurement
+    is actually taken.
+
+    Note
+    ----
+    This function is memoized, to skip repeated board round-trips for the same
+    actuation voltage.  The ``frequency`` argument is only used as part of the
+    cache key and **must** match the current waveform frequency of the board.
+    '''
+    control_board.set_waveform_voltage(voltage_uV * 1e-6)
+    return measure_board_rms(control_board, n_samples=n_samples,
+                             sampling_ms=sampling_ms,
+                             delay_between_samples_ms=delay_between_samples_ms)
 
 
 def find_good(control_board, actuation_steps, resistor_index, start_index,
-              end_index):
+              end_index, frequency=None):
     '''
     Use a binary search over the range of provided actuation_steps to find the
     maximum actuation voltage that is measured by the board feedback circuit
     using the specified feedback resistor.
+
+    If ``frequency`` is set, it must match the current waveform frequency of
+    the board.  In this case, measurements are memoized by frequency and
+    actuation voltage (see :func:`_cached_board_rms`).
     '''
+    def measure(v):
+        if frequency is None:
+            control_board.set_waveform_voltage(v)
+            return measure_board_rms(control_board)
+        else:
+            return _cached_board_rms(control_board, frequency,
+                                     int(round(v * 1e6)), 10, 10, 0)
+
     lower = start_index
     upper = end_index
     while lower < upper - 1:
-        index = lower + (upper - lower) / 2
-        v = actuation_steps[index]
-        control_board.set_waveform_voltage(v)
-        data = measure_board_rms(control_board)
-        valid_data = data[data['divider resistor index'] >= 0]
+        index = (lower + upper) // 2
+        rms = measure(actuation_steps[index])
+        valid_hv_resistor = rms.hv_resistor[rms.hv_resistor >= 0]
 
-        if (valid_data['divider resistor index'] < resistor_index).sum():
+        if (valid_hv_resistor < resistor_index).any():
             # We have some measurements from another resistor.
             upper = index
         else:
             lower = index
+    # Explicitly set the waveform voltage, since the board may be set to a
+    # different voltage if the measurement below is read from the cache.
     control_board.set_waveform_voltage(actuation_steps[lower])
-    data = measure_board_rms(control_board)
-    return lower, data
+    rms = measure(actuation_steps[lower])
+    return lower, rms
 
 
 def resistor_max_actuation_readings(control_board, frequencies,
@@ -86,53 +141,230 @@ def resistor_max_actuation_readings(control_board, frequencies,
 
     # Based on the maximum amplified RMS voltage, define a set of actuation
     # voltages to search when performing calibration.
+    #
+    # The voltage ranges of the feedback resistors are spread over several
+    # orders of magnitude, so the actuation voltages are spaced
+    # logarithmically to provide the same relative resolution for each
+    # resistor.
     max_post_gain_V = 0.8 * control_board.max_waveform_voltage
     max_actuation_V = max_post_gain_V / estimated_amplifier_gain
-    actuation_steps = np.linspace(0.005, max_actuation_V, num=50)
+    actuation_steps = np.logspace(np.log10(0.005), np.log10(max_actuation_V),
+                                  num=32)
 
     resistor_count = len(control_board.a0_series_resistance)
 
-    # Define frequency/resistor index pairs to take measurements at.
-    conditions = pd.DataFrame([[r, f] for r in range(resistor_count - 1, -1, -1)
-                               for f in frequencies],
-                              columns=['resistor index', 'frequency'])
-
-    # Define function to process each frequency/resistor index pair.
-    def max_actuation_reading(x):
-        '''
-        Measure maximum board RMS voltage using specified feedback resistor, at
-        the specified frequency.
-
-        Request corresponding oscilloscope RMS voltage reading.
-        '''
-        r = x['resistor index'].values[0]
-        f = x['frequency'].values[0]
-        control_board.set_waveform_frequency(f)
-
-        actuation_index, data = find_good(control_board, actuation_steps, r, 0,
-                                          len(actuation_steps) - 1)
-        board_measured_rms = data.loc[data['divider resistor index'] >= 0,
-                                      'board measured V'].mean()
-        oscope_rms = oscope_reading_func()
-        print 'R=%s, f=%s' % (r, f)
-        return pd.DataFrame([[r, f, actuation_index, board_measured_rms,
-                              oscope_rms]],
-                            columns=['resistor index', 'frequency',
-                                     'actuation index', 'board measured V',
-                                     'oscope measured V'])
+    # Discard any board measurements memoized before this calibration, since
+    # the state of the board _(e.g., amplifier gain)_ may have changed.
+    _cached_board_rms.cache_clear()
+
+    # Measure maximum board RMS voltage using each feedback resistor, at each
+    # frequency, along with the corresponding oscilloscope RMS voltage
+    # reading.
+    rows = []
+    try:
+        for r, f in itertools.product(range(resistor_count - 1, -1, -1),
+                                      frequencies):
+            control_board.set_waveform_frequency(f)
+
+            actuation_index, rms = find_good(control_board, actuation_steps, r,
+                                             0, len(actuation_steps) - 1,
+                                             frequency=f)
+            valid = rms.hv_resistor >= 0
+            board_measured_rms = (rms.V[valid].mean() if valid.any()
+                                  else np.nan)
+            oscope_rms = oscope_reading_func()
+            print('R=%s, f=%s' % (r, f))
+            rows.append((r, f, actuation_index, board_measured_rms,
+                         oscope_rms))
+    finally:
+        # Release memoized measurements, along with the reference to the
+        # control board held by the cache keys.
+        _cached_board_rms.cache_clear()
 
     # Return board-measured RMS voltage and oscilloscope-measured RMS voltage
     # for each frequency/feedback resistor pair.
-    return (conditions.groupby(['resistor index', 'frequency'])
-            .apply(max_actuation_reading).reset_index(drop=True))
+    return pd.DataFrame(rows, columns=['resistor index', 'frequency',
+                                       'actuation index', 'board measured V',
+                                       'oscope measured V'])
+
+
+def _V1_hw1(V2, R1, R2, C2, f):
+    '''
+    Magnitude of ``V1`` computed from ``V2`` using the control board hardware
+    version 1 feedback transfer function, i.e., ``V1 = V2 * (Z1 + Z2) / Z2``,
+    where ``Z1 = R1`` and ``Z2`` is ``R2`` in parallel with ``C2``.
+    '''
+    return V2 * np.sqrt((1 + R1 / R2) ** 2 + (2 * np.pi * f * R1 * C2) ** 2)
+
+
+def _V1_hw1_jacobian(V2, R1, R2, C2, f):
+    '''
+    Partial derivatives of :func:`_V1_hw1` with respect to ``R2`` and ``C2``,
+    respectively.
+    '''
+    a = 1 + R1 / R2
+    b = 2 * np.pi * f * R1
+    root = np.sqrt(a ** 2 + (b * C2) ** 2)
+    return -V2 * a * R1 / (R2 ** 2 * root), V2 * b ** 2 * C2 / root
+
+
+def _V1_hw2(V2, R1, R2, C2, f):
+    '''
+    Magnitude of ``V1`` computed from ``V2`` using the control board hardware
+    version 2 feedback transfer function, i.e., ``V1 = V2 * Z1 / Z2``, where
+    ``Z1 = R1`` and ``Z2`` is ``R2`` in parallel with ``C2``.
+    '''
+    return V2 * R1 * np.sqrt(1 / R2 ** 2 + (2 * np.pi * f * C2) ** 2)
+
+
+def _V1_hw2_jacobian(V2, R1, R2, C2, f):
+    '''
+    Partial derivatives of :func:`_V1_hw2` with respect to ``R2`` and ``C2``,
+    respectively.
+    '''
+    omega = 2 * np.pi * f
+    root = np.sqrt(1 / R2 ** 2 + (omega * C2) ** 2)
+    return -V2 * R1 / (R2 ** 3 * root), V2 * R1 * omega ** 2 * C2 / root
+
+
+if numba is not None:
+    # Compile the kernels evaluated by the least-squares fit, since they are
+    # called many times per fit.
+    _V1_hw1 = numba.njit(cache=True, fastmath=True)(_V1_hw1)
+    _V1_hw1_jacobian = numba.njit(cache=True, fastmath=True)(_V1_hw1_jacobian)
+    _V1_hw2 = numba.njit(cache=True, fastmath=True)(_V1_hw2)
+    _V1_hw2_jacobian = numba.njit(cache=True, fastmath=True)(_V1_hw2_jacobian)
+
+# Closed-form `V1` magnitude kernel for each control board hardware major
+# version.  Equivalent to the result of:
+#
+#     compute_from_transfer_function(<major>, 'V1', V2=V2, R1=R1, R2=R2, C2=C2,
+#                                    f=f)
+_V1_FUNCS = {1: _V1_hw1, 2: _V1_hw2}
+# Closed-form partial derivatives of each `V1` kernel with respect to `R2` and
+# `C2`.
+_V1_JACOBIAN_FUNCS = {1: _V1_hw1_jacobian, 2: _V1_hw2_jacobian}
+
+
+def compute_attenuation(hardware_major_version, R1, R2, C2, f):
+    '''
+    Compute the attenuation _(i.e., ``V2 / V1``)_ of the high-voltage feedback
+    circuit for the specified control board hardware major version.
+
+    Equivalent to, but much faster than::
 
+        compute_from_transfer_function(hardware_major_version, 'V2', V1=1.,
+                                       R1=R1, R2=R2, C2=C2, f=f)
 
-def fit_feedback_params(calibration, max_resistor_readings):
+    Parameters
+    ----------
+    hardware_major_version : int
+        Major version of control board hardware *(1 or 2)*.
+    R1, R2, C2, f : float or array-like
+        Scalar or array values, broadcast according to :mod:`numpy` rules.
+
+    Returns
+    -------
+    float or numpy.ndarray
+        Attenuation of high-voltage feedback circuit.
+    '''
+    return 1. / _V1_FUNCS[hardware_major_version](1., R1, R2, C2, f)
+
+
+# Physically plausible range of high-voltage feedback resistor values _(in
+# ohms)_ and parasitic capacitance values _(in farads)_.
+R_BOUNDS = (1., 1e11)
+C_BOUNDS = (1e-15, 1e-6)
+
+
+# Version of the feedback model and fitting procedure, included in the key of
+# fit results cached on disk by :func:`fit_feedback_params`.
+#
+# __NB__ Increment whenever a change to the model kernels or the fit may change
+# the fitted values, to invalidate previously cached results.
+FIT_CACHE_VERSION = 1
+
+
+def _fit_cache_key(hw_major_version, R1, p0, readings):
+    '''
+    Return SHA256 hex digest identifying the inputs of a feedback fit.
+    '''
+    digest = hashlib.sha256()
+    digest.update(repr((FIT_CACHE_VERSION, hw_major_version, R1, R_BOUNDS,
+                        C_BOUNDS, list(readings.columns))).encode('utf8'))
+    for values in (p0, readings.values):
+        digest.update(np.ascontiguousarray(values, dtype=float).tobytes())
+    return digest.hexdigest()
+
+
+def fit_feedback_params(calibration, max_resistor_readings, cache_dir=None):
     '''
     Fit model of control board high-voltage feedback resistor and
     parasitic capacitance values based on measured voltage readings.
+
+    The resistor and capacitor values for all feedback resistors are fitted
+    together in a single least-squares problem, where the parameter vector is
+    ``[R_0, C_0, R_1, C_1, ...]``.  Fitted values are bounded to the ranges
+    :data:`R_BOUNDS` and :data:`C_BOUNDS`.
+
+    If ``cache_dir`` is set, fitted parameters are stored in that
+    directory, keyed by a hash of the hardware major version, the initial
+    resistor and capacitor values, and the readings.  Fitting the same
+    readings again loads the stored result instead of repeating the fit.
     '''
     R1 = 10e6
+    hw_major_version = calibration.hw_version.major
+
+    readings = max_resistor_readings[max_resistor_readings['resistor index']
+                                     >= 0]
+    resistor_indices = np.unique(readings['resistor index'].values)
+
+    p0 = np.empty(2 * len(resistor_indices))
+    p0[0::2] = [calibration.R_hv[i] for i in resistor_indices]
+    p0[1::2] = [calibration.C_hv[i] for i in resistor_indices]
+
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, 'feedback_params-%s.pickle' %
+                                  _fit_cache_key(hw_major_version, R1, p0,
+                                                 readings))
+        if os.path.isfile(cache_path):
+            try:
+                data = pd.read_pickle(cache_path)
+            except Exception:
+                logger.warning('Could not load fitted feedback params from '
+                               '`%s`.  Refitting.', cache_path, exc_info=True)
+            else:
+                logger.debug('Load fitted feedback params from `%s`',
+                             cache_path)
+                return data
+
+    # __NB__ The board measured voltage is `NaN` if no valid samples were
+    # measured _(see `resistor_max_actuation_readings`)_.  Since all resistors
+    # are fitted together, a single non-finite residual would prevent fitting
+    # *any* of the resistors, so exclude such readings from the fit.
+    finite = np.isfinite(readings[['board measured V',
+                                   'oscope measured V']].values).all(axis=1)
+    if not finite.all():
+        logger.warning('Excluding %d of %d readings with non-finite voltages '
+                       'from feedback fit.', (~finite).sum(), len(finite))
+        readings = readings[finite]
+    # Map each reading to the corresponding pair of entries in the vector of
+    # fitted parameters.
+    fitted_indices, group_ids = np.unique(readings['resistor index'].values,
+                                          return_inverse=True)
+    frequency = readings['frequency'].values
+    board_V = readings['board measured V'].values
+    oscope_V = readings['oscope measured V'].values
+
+    # Resistors without any finite readings keep their original values.
+    fitted = np.repeat(np.in1d(resistor_indices, fitted_indices), 2)
+    if not fitted.all():
+        logger.warning('No finite readings for feedback resistor(s) %s. '
+                       'Keeping original values.',
+                       resistor_indices[~fitted[0::2]].tolist())
+
+    lower_bounds = np.tile([R_BOUNDS[0], C_BOUNDS[0]], len(fitted_indices))
+    upper_bounds = np.tile([R_BOUNDS[1], C_BOUNDS[1]], len(fitted_indices))
 
     # Get transfer function to compute the amplitude of the high-voltage input
     # to the control board _(i.e., the output of the amplifier)_ based on the
@@ -141,37 +373,66 @@ def fit_feedback_params(calibration, max_resistor_readings):
     #
     # The signature of the transfer function is:
     #
-    #     H(V1, R1, C1, R2, C2, f)
+    #     H(V2, R1, R2, C2, f)
     #
     # See the `z_transfer_functions` function docstring for definitions of the
     # parameters based on the control board major version.
-    def fit_resistor_params(x):
-        resistor_index = x['resistor index'].values[0]
-        p0 = [calibration.R_hv[resistor_index],
-              calibration.C_hv[resistor_index]]
-
-        def error(p, df, R1):
-            v1 = compute_from_transfer_function(calibration.hw_version.major,
-                                                'V1',
-                                                V2=df['board measured V'],
-                                                R1=R1, R2=p[0], C2=p[1],
-                                                f=df['frequency'].values)
-            e = df['oscope measured V'] - v1
-            return e
-
-        p1, success = optimize.leastsq(error, p0, args=(x, R1))
-        # take the absolute value of the fitted values, since is possible
-        # for the fit to produce negative resistor and capacitor values
-        p1 = np.abs(p1)
-        return pd.DataFrame([p0 + p1.tolist()],
-                            columns=['original R', 'original C',
-                                     'fitted R', 'fitted C']).T
-
-    results = (max_resistor_readings
-               [max_resistor_readings['resistor index'] >= 0]
-               .groupby(['resistor index']).apply(fit_resistor_params))
-    data = results.unstack()
-    data.columns = data.columns.droplevel()
+    V1_func = _V1_FUNCS[hw_major_version]
+
+    def error(p, R1):
+        v1 = V1_func(board_V, R1, p[0::2][group_ids], p[1::2][group_ids],
+                     frequency)
+        return oscope_V - v1
+
+    V1_jacobian_func = _V1_JACOBIAN_FUNCS[hw_major_version]
+    rows = np.arange(len(group_ids))
+
+    def jacobian(p, R1):
+        # Each reading only depends on the resistor and capacitor values of
+        # the corresponding feedback resistor.
+        dV1_dR2, dV1_dC2 = V1_jacobian_func(board_V, R1, p[0::2][group_ids],
+                                            p[1::2][group_ids], frequency)
+        J = np.zeros((len(group_ids), len(p)))
+        J[rows, 2 * group_ids] = -dV1_dR2
+        J[rows, 2 * group_ids + 1] = -dV1_dC2
+        return J
+
+    # __NB__ The initial guess must be within bounds.  Resistor and
+    # capacitor values differ by many orders of magnitude, so scale each
+    # parameter according to the Jacobian.
+    p1 = p0.copy()
+    if fitted.any():
+        result = optimize.least_squares(error,
+                                        np.clip(p0[fitted], lower_bounds,
+                                                upper_bounds),
+                                        jac=jacobian,
+                                        bounds=(lower_bounds, upper_bounds),
+                                        method='trf', x_scale='jac',
+                                        args=(R1, ))
+        p1[fitted] = result.x
+    data = pd.DataFrame({'original R': p0[0::2], 'original C': p0[1::2],
+                         'fitted R': p1[0::2], 'fitted C': p1[1::2]},
+                        columns=['original R', 'original C', 'fitted R',
+                                 'fitted C'],
+                        index=pd.Index(resistor_indices,
+                                       name='resistor index'))
+    if cache_dir is not None:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to a temporary file and move it into place, so an interrupted
+        # write does not leave a truncated cache file behind.
+        fd, temp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+        os.close(fd)
+        try:
+            data.to_pickle(temp_path)
+            if os.path.isfile(cache_path):
+                # __NB__ On Windows, `os.rename` fails if the destination
+                # exists _(e.g., a cache file that could not be loaded)_.
+                os.remove(cache_path)
+            os.rename(temp_path, cache_path)
+        finally:
+            if os.path.isfile(temp_path):
+                os.remove(temp_path)
     return data
 
 
@@ -198,47 +459,57 @@ def plot_feedback_params(hw_major_version, max_resistor_readings,
     # Since the feedback circuit changed in version 2 of the control board, we
     # use the transfer function that corresponds to the current control board
     # version that the fitted attenuation model is based on.
+
+    # __NB__ `matplotlib` is imported here, rather than at the module level,
+    # since it is only required for plotting.  `pyplot` is only imported if
+    # no axis is provided, to avoid selecting a backend unnecessarily.
+    from matplotlib.markers import MarkerStyle
+
     if axis is None:
+        import matplotlib.pyplot as plt
+
         fig = plt.figure()
         axis = fig.add_subplot(111)
 
     markers = MarkerStyle.filled_markers
 
-    def plot_resistor_params(args):
-        resistor_index, x = args
-
-        try:
-            color = axis._get_lines.color_cycle.next()
-        except: # make compatible with matplotlib v1.5
-            color = axis._get_lines.prop_cycler.next()['color']
-
-        F = feedback_params.loc[resistor_index]
-        # Broadcast values in case sympy function simplifies to scalar value.
-        values = np.empty_like(x['frequency'])
-        values[:] = compute_from_transfer_function(hw_major_version, 'V2',
-                                                   V1=1., R1=R1,
-                                                   R2=F['original R'],
-                                                   C2=F['original C'],
-                                                   f=x['frequency'])
-        axis.loglog(x['frequency'], values, color=color, linestyle='--',
-                    label='R$_{%d}$ (previous fit)' % resistor_index)
-
-        values[:] = compute_from_transfer_function(hw_major_version, 'V2',
-                                                   V1=1., R1=R1,
-                                                   R2=F['fitted R'],
-                                                   C2=F['fitted C'],
-                                                   f=x['frequency'])
-        axis.loglog(x['frequency'], values, color=color, linestyle='-',
-                    alpha=0.6, label='R$_{%d}$ (new fit)' % resistor_index)
-        attenuation = x['board measured V'] / x['oscope measured V']
-        axis.plot(x['frequency'], attenuation, color='none',
+    # Evaluate the previous and the newly fitted attenuation models of all
+    # feedback resistors at the measured frequencies _(resistor values are
+    # broadcast along the first axis)_.
+    frequencies = np.unique(max_resistor_readings['frequency'].values)
+
+    def attenuation_curves(R_column, C_column):
+        values = compute_attenuation(
+            hw_major_version, R1,
+            feedback_params[R_column].values[:, np.newaxis],
+            feedback_params[C_column].values[:, np.newaxis], frequencies)
+        return dict(zip(feedback_params.index, values))
+
+    previous_curves = attenuation_curves('original R', 'original C')
+    fitted_curves = attenuation_curves('fitted R', 'fitted C')
+
+    # Compute the measured attenuation of all readings at once, rather than
+    # for each resistor group.
+    readings = max_resistor_readings.assign(
+        attenuation=max_resistor_readings['board measured V'].values /
+        max_resistor_readings['oscope measured V'].values)
+
+    for resistor_index, x in readings.groupby('resistor index'):
+        # Use the next color in the axis color cycle for the first curve of
+        # each resistor, and the same color for the remaining plots.
+        line, = axis.loglog(frequencies, previous_curves[resistor_index],
+                            linestyle='--',
+                            label='R$_{%d}$ (previous fit)' % resistor_index)
+        color = line.get_color()
+        axis.loglog(frequencies, fitted_curves[resistor_index], color=color,
+                    linestyle='-', alpha=0.6,
+                    label='R$_{%d}$ (new fit)' % resistor_index)
+        axis.plot(x['frequency'], x['attenuation'], color='none',
                   marker=markers[resistor_index % len(markers)],
                   label='R$_{%d}$ (scope measured)' % resistor_index,
                   linestyle='none', markeredgecolor=color, markeredgewidth=2,
                   markersize=8)
-        return 0
 
-    map(plot_resistor_params, max_resistor_readings.groupby('resistor index'))
     legend = axis.legend(ncol=3)
     legend.draw_frame(False)
     axis.set_xlabel('Frequency (Hz)')
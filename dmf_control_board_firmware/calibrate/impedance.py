@@ -1,6 +1,5 @@
 # coding: utf-8
 from collections import OrderedDict
-import time
 
 import numpy as np
 import sympy as sp
@@ -9,7 +8,7 @@ import scipy.optimize
 import pandas as pd
 
 from . import capacitive_load_func
-from .feedback import compute_from_transfer_function, get_transfer_function
+from .feedback import compute_from_transfer_function
 
 
 # Default frequencies to test
@@ -2,7 +2,6 @@
 import pandas as pd
 import matplotlib.mlab as mlab
 import matplotlib.pyplot as plt
-from matplotlib.colors import Colormap
 from matplotlib.gridspec import GridSpec
 import numpy as np
 
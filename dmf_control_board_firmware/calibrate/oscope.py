@@ -1,8 +1,6 @@
 import logging
 
 import pandas as pd
-import time
-import warnings
 
 try:
     import visa
@@ -27,17 +25,26 @@ class AgilentOscope(object):
                        if a.startswith('USB')][0]
         self.device = self.rm.get_instrument(address)
 
-    def read_ac_vrms(self):
+    def _read(self):
+        for i in xrange(5):
+            try:
+                return self.device.read()
+            except visa.VisaIOError:
+                pass
+        raise
+
+    def autoscale(self):
         self.device.write("AUTOSCALE")
+        # Block until the oscilloscope has finished autoscaling.
+        self.device.write("*OPC?")
+        self._read()
+
+    def read_ac_vrms(self):
+        self.autoscale()
 
         def get_V():
             self.device.write("MEASURE:VRMS? DISPLAY,AC")
-            for i in xrange(5):
-                try:
-                    return float(self.device.read())
-                except visa.VisaIOError:
-                    pass
-            raise
+            return float(self._read())
 
         return pd.Series([get_V() for i in xrange(5)]).median()
 
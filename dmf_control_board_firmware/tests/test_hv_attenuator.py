@@ -0,0 +1,292 @@
+from collections import namedtuple
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+import sympy as sp
+
+from dmf_control_board_firmware.calibrate.feedback import \
+    compute_from_transfer_function, get_transfer_function, limit_default
+import dmf_control_board_firmware.calibrate.hv_attenuator as hv_attenuator
+from dmf_control_board_firmware.calibrate.hv_attenuator import \
+    _V1_FUNCS, _V1_JACOBIAN_FUNCS, _cached_board_rms, compute_attenuation, \
+    fit_feedback_params, resistor_max_actuation_readings
+
+
+R1 = 10e6
+# Actual resistor and capacitor values of the simulated feedback circuit.
+R_HV = np.array([8.7e4, 6.4e5, 2.3e6])
+C_HV = np.array([1.5e-10, 1.2e-11, 3.3e-12])
+# Maximum amplifier output voltage that may be measured using each feedback
+# resistor.
+MAX_HV = np.array([220., 60., 12.])
+
+ImpedanceResults = namedtuple('ImpedanceResults', 'V_hv hv_resistor')
+Calibration = namedtuple('Calibration', 'R_hv C_hv hw_version')
+HardwareVersion = namedtuple('HardwareVersion', 'major')
+
+
+class FakeControlBoard(object):
+    '''
+    Simulated control board, with an ideal amplifier and high-voltage feedback
+    resistor bank.
+    '''
+    max_waveform_voltage = 200.
+
+    def __init__(self, hw_major_version=2, gain=150., fail_frequency=None):
+        self.hw_major_version = hw_major_version
+        self.gain = gain
+        self.fail_frequency = fail_frequency
+        self.a0_series_resistance = np.array([1e5, 5e5, 2e6])
+        self.a0_series_capacitance = np.array([1e-10, 1e-11, 1e-12])
+        self.voltage = 0
+        self.frequency = 1e3
+        # `(frequency, voltage)` of each call to `measure_impedance`.
+        self.measurements = []
+
+    def set_waveform_voltage(self, voltage):
+        self.voltage = voltage
+
+    def set_waveform_frequency(self, frequency):
+        self.frequency = frequency
+
+    def output_voltage(self):
+        return self.voltage * self.gain
+
+    def measure_impedance(self, n_samples, *args):
+        self.measurements.append((self.frequency, self.voltage))
+        if self.frequency == self.fail_frequency:
+            raise RuntimeError('Current limit exceeded.')
+        V1 = self.output_voltage()
+        # Use the most sensitive feedback resistor that is not saturated.
+        in_range = np.where(V1 < MAX_HV)[0]
+        resistor_index = in_range[-1] if len(in_range) else -1
+        V2 = V1 * compute_attenuation(self.hw_major_version, R1,
+                                      R_HV[max(resistor_index, 0)],
+                                      C_HV[max(resistor_index, 0)],
+                                      self.frequency)
+        return ImpedanceResults(np.repeat(V2, n_samples),
+                                np.repeat(resistor_index, n_samples))
+
+
+def test_V1_kernels():
+    V2 = np.linspace(0.1, 4.5, 20)
+    f = np.logspace(2, np.log10(20e3), 20)
+    R1 = 10e6
+
+    for hw_major_version, V1_func in _V1_FUNCS.items():
+        for R2, C2 in [(1e5, 1e-10), (5e5, 1e-11), (2e6, 1e-12)]:
+            expected = compute_from_transfer_function(hw_major_version, 'V1',
+                                                      V2=V2, R1=R1, R2=R2,
+                                                      C2=C2, f=f)
+            result = V1_func(V2, R1, np.repeat(R2, len(V2)),
+                             np.repeat(C2, len(V2)), f)
+            assert np.allclose(result, expected, rtol=1e-10, atol=0)
+
+
+def test_V1_jacobian_kernels():
+    V2 = np.linspace(0.1, 4.5, 20)
+    f = np.logspace(2, np.log10(20e3), 20)
+    R1 = 10e6
+
+    for hw_major_version, jacobian_func in _V1_JACOBIAN_FUNCS.items():
+        # Differentiate the magnitude of the symbolic transfer function, with
+        # `C1` open circuit _(as in `compute_from_transfer_function`)_.
+        H = get_transfer_function(hw_major_version, solve_for='V1')
+        H = limit_default(H, ['C1'], 0).subs('omega',
+                                             sp.sympify('2 * pi * f'))
+        symbols = dict([(s.name, sp.Symbol(s.name, positive=True))
+                        for s in H.rhs.atoms(sp.Symbol)])
+        V1 = sp.Abs(H.rhs.subs(symbols.items()))
+        args = [symbols[s] for s in ('V2', 'R1', 'R2', 'C2', 'f')]
+
+        for R2, C2 in [(1e5, 1e-10), (5e5, 1e-11), (2e6, 1e-12)]:
+            R2_ = np.repeat(R2, len(V2))
+            C2_ = np.repeat(C2, len(V2))
+            result = jacobian_func(V2, R1, R2_, C2_, f)
+            for i, s in enumerate(('R2', 'C2')):
+                expected = sp.lambdify(args, sp.diff(V1, symbols[s]),
+                                       'numpy')(V2, R1, R2_, C2_, f)
+                assert np.allclose(result[i], expected, rtol=1e-10, atol=0)
+
+
+def test_compute_attenuation():
+    f = np.logspace(2, np.log10(20e3), 20)
+    R1 = 10e6
+    R2 = np.array([[1e5], [5e5], [2e6]])
+    C2 = np.array([[1e-10], [1e-11], [1e-12]])
+
+    for hw_major_version in (1, 2):
+        expected = compute_from_transfer_function(hw_major_version, 'V2',
+                                                  V1=1., R1=R1, R2=R2, C2=C2,
+                                                  f=f)
+        result = compute_attenuation(hw_major_version, R1, R2, C2, f)
+        assert result.shape == (len(R2), len(f))
+        assert np.allclose(result, expected, rtol=1e-10, atol=0)
+
+
+def simulated_readings(hw_major_version, frequencies):
+    '''
+    Return readings of the simulated feedback circuit for each feedback
+    resistor at each frequency, in the format returned by
+    `resistor_max_actuation_readings`.
+    '''
+    resistor_index, frequency = [a.ravel() for a in
+                                 np.meshgrid(range(len(R_HV)), frequencies,
+                                             indexing='ij')]
+    oscope_V = 0.9 * MAX_HV[resistor_index]
+    board_V = oscope_V * compute_attenuation(hw_major_version, R1,
+                                             R_HV[resistor_index],
+                                             C_HV[resistor_index], frequency)
+    return pd.DataFrame({'resistor index': resistor_index,
+                         'frequency': frequency,
+                         'actuation index': 0,
+                         'board measured V': board_V,
+                         'oscope measured V': oscope_V},
+                        columns=['resistor index', 'frequency',
+                                 'actuation index', 'board measured V',
+                                 'oscope measured V'])
+
+
+def get_calibration(hw_major_version):
+    return Calibration(np.array([1e5, 5e5, 2e6]),
+                       np.array([1e-10, 1e-11, 1e-12]),
+                       HardwareVersion(hw_major_version))
+
+
+def test_fit_feedback_params_nan_reading():
+    frequencies = np.logspace(2, 4, 6)
+
+    for hw_major_version in (1, 2):
+        readings = simulated_readings(hw_major_version, frequencies)
+        # Failed board measurement _(see `resistor_max_actuation_readings`)_.
+        readings.loc[4, 'board measured V'] = np.nan
+
+        fitted = fit_feedback_params(get_calibration(hw_major_version),
+                                     readings)
+        # All resistors are fitted, including the resistor with the failed
+        # reading.
+        assert fitted.index.tolist() == list(range(len(R_HV)))
+        assert np.allclose(fitted['fitted R'], R_HV, rtol=1e-6)
+        assert np.allclose(fitted['fitted C'], C_HV, rtol=1e-6)
+
+
+def test_fit_feedback_params_no_finite_readings():
+    frequencies = np.logspace(2, 4, 6)
+
+    for hw_major_version in (1, 2):
+        calibration = get_calibration(hw_major_version)
+        readings = simulated_readings(hw_major_version, frequencies)
+        # All board measurements using resistor 1 failed.
+        readings.loc[readings['resistor index'] == 1,
+                     'board measured V'] = np.nan
+
+        fitted = fit_feedback_params(calibration, readings)
+        # The resistor without any finite readings keeps its original values,
+        # while the remaining resistors are fitted.
+        assert fitted.index.tolist() == list(range(len(R_HV)))
+        assert fitted.loc[1, 'fitted R'] == calibration.R_hv[1]
+        assert fitted.loc[1, 'fitted C'] == calibration.C_hv[1]
+        assert np.allclose(fitted.loc[[0, 2], 'fitted R'], R_HV[[0, 2]],
+                           rtol=1e-6)
+        assert np.allclose(fitted.loc[[0, 2], 'fitted C'], C_HV[[0, 2]],
+                           rtol=1e-6)
+
+        # No finite readings at all.
+        readings['board measured V'] = np.nan
+        fitted = fit_feedback_params(calibration, readings)
+        assert (fitted['fitted R'] == fitted['original R']).all()
+        assert (fitted['fitted C'] == fitted['original C']).all()
+
+
+def test_fit_feedback_params_cache():
+    calibration = get_calibration(2)
+    readings = simulated_readings(2, np.logspace(2, 4, 6))
+    cache_dir = os.path.join(tempfile.mkdtemp(), 'cache')
+
+    try:
+        fitted = fit_feedback_params(calibration, readings,
+                                     cache_dir=cache_dir)
+        cache_files = os.listdir(cache_dir)
+        assert len(cache_files) == 1
+        assert cache_files[0].endswith('.pickle')
+
+        def least_squares(*args, **kwargs):
+            raise AssertionError('Fit was not loaded from cache.')
+
+        # Fitting the same readings again must load the cached result.
+        optimize = hv_attenuator.optimize
+        hv_attenuator.optimize = namedtuple('optimize',
+                                            'least_squares')(least_squares)
+        try:
+            cached = fit_feedback_params(calibration, readings,
+                                         cache_dir=cache_dir)
+        finally:
+            hv_attenuator.optimize = optimize
+        assert cached.equals(fitted)
+
+        # A truncated cache file _(e.g., from an interrupted write)_ is
+        # treated as a cache miss and replaced.
+        cache_path = os.path.join(cache_dir, cache_files[0])
+        with open(cache_path, 'rb') as input_:
+            data = input_.read()
+        with open(cache_path, 'wb') as output:
+            output.write(data[:len(data) // 2])
+        assert fit_feedback_params(calibration, readings,
+                                   cache_dir=cache_dir).equals(fitted)
+        assert pd.read_pickle(cache_path).equals(fitted)
+        assert os.listdir(cache_dir) == cache_files
+
+        # Any change to the readings results in a new fit.
+        readings.loc[0, 'oscope measured V'] *= 1.01
+        fit_feedback_params(calibration, readings, cache_dir=cache_dir)
+        assert len(os.listdir(cache_dir)) == 2
+    finally:
+        shutil.rmtree(os.path.dirname(cache_dir))
+
+
+def test_resistor_max_actuation_readings():
+    frequencies = [1e2, 1e3, 1e4]
+
+    for hw_major_version in (1, 2):
+        control_board = FakeControlBoard(hw_major_version)
+        readings = resistor_max_actuation_readings(
+            control_board, frequencies, control_board.output_voltage)
+
+        assert (readings.columns.tolist() ==
+                ['resistor index', 'frequency', 'actuation index',
+                 'board measured V', 'oscope measured V'])
+        assert len(readings) == len(R_HV) * len(frequencies)
+        assert (sorted(set(readings['resistor index'])) ==
+                list(range(len(R_HV))))
+        # Each reading is taken at a voltage below the saturation limit of the
+        # corresponding resistor, so the measured attenuation matches the
+        # simulated feedback circuit.
+        assert (readings['oscope measured V'].values <
+                MAX_HV[readings['resistor index'].values]).all()
+        expected = compute_attenuation(
+            hw_major_version, R1, R_HV[readings['resistor index'].values],
+            C_HV[readings['resistor index'].values],
+            readings['frequency'].values)
+        assert np.allclose(readings['board measured V'] /
+                           readings['oscope measured V'], expected)
+
+        # Measurements are memoized, so the board is never measured twice at
+        # the same frequency and voltage...
+        assert (len(set(control_board.measurements)) ==
+                len(control_board.measurements))
+        # ...and the memoized measurements are released after calibration.
+        assert _cached_board_rms.cache_info().currsize == 0
+
+
+def test_resistor_max_actuation_readings_failed_measurement():
+    control_board = FakeControlBoard(fail_frequency=1e3)
+    readings = resistor_max_actuation_readings(control_board, [1e2, 1e3],
+                                               control_board.output_voltage)
+
+    failed = readings['frequency'] == 1e3
+    assert readings.loc[failed, 'board measured V'].isnull().all()
+    assert readings.loc[~failed, 'board measured V'].notnull().all()
+    assert _cached_board_rms.cache_info().currsize == 0
@@ -25,10 +25,10 @@ setup(name='dmf-control-board-firmware',
       packages=['dmf_control_board_firmware'],
       include_package_data=True,
       install_requires=['decorator', 'functools32', 'matplotlib',
-                        'microdrop-utility', 'scipy', 'serial_device>=0.4',
-                        'svg-model>=0.5.post20', 'sympy', 'tables',
-                        'wheeler.base-node>=0.3.post2', 'pandas>=0.17',
-                        'arrow'],
+                        'microdrop-utility', 'scipy>=0.17',
+                        'serial_device>=0.4', 'svg-model>=0.5.post20', 'sympy',
+                        'tables', 'wheeler.base-node>=0.3.post2',
+                        'pandas>=0.17', 'arrow'],
       extras_require={'build': ['arduino-scons>=v0.1.post11', 'SCons>=2.4.1']})
 
 